@@ -1,17 +1,55 @@
+import asyncio
 import datetime
+import functools
 import logging.config
 from environs import Env
 from seller import download_stock
 
 import requests
-
-from seller import divide, price_conversion
+from urllib3.exceptions import ReadTimeoutError
+
+from seller import (
+    REQUEST_TIMEOUT,
+    divide,
+    load_json,
+    prices_conversion,
+    session,
+    stock_conversion,
+    upload_batches,
+    upload_body,
+)
 
 logger = logging.getLogger(__file__)
 
+MARKET_HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+    "Host": "api.partner.market.yandex.ru",
+}
+MARKET_URL = "https://api.partner.market.yandex.ru/campaigns/{campaign_id}/"
+OFFER_MAPPING_URL = MARKET_URL + "offer-mapping-entries"
+STOCKS_URL = MARKET_URL + "offers/stocks"
+PRICES_URL = MARKET_URL + "offer-prices/updates"
+
+
+@functools.lru_cache(maxsize=None)
+def market_headers(access_token):
+    """Собрать заголовки запроса к api Яндекс Маркета.
+
+    Результат кешируется по токену, поэтому словарь не пересоздаётся
+    на каждой странице и партии. Изменять возвращаемый словарь нельзя.
+
+    Args:
+        access_token (str): Токен продавца для аутентификации запроса.
+
+    Returns:
+        dict: Заголовки запроса.
+    """
+    return {**MARKET_HEADERS, "Authorization": f"Bearer {access_token}"}
+
 
 def get_product_list(page, campaign_id, access_token):
-     """Получить список товаров.
+    """Получить список товаров.
 
     Args:
         page (int): Номер страницы, которая должна быть получена.
@@ -25,21 +63,17 @@ def get_product_list(page, campaign_id, access_token):
         HTTPError: Ответ с кодом 4xx или 5xx.
         ConnectionError: Проблемы подключения к серверу.
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
     payload = {
         "page_token": page,
         "limit": 200,
     }
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-mapping-entries"
-    response = requests.get(url, headers=headers, params=payload)
+    headers = market_headers(access_token)
+    url = OFFER_MAPPING_URL.format(campaign_id=campaign_id)
+    response = session.get(
+        url, headers=headers, params=payload, timeout=REQUEST_TIMEOUT
+    )
     response.raise_for_status()
-    response_object = response.json()
+    response_object = load_json(response.content)
     return response_object.get("result")
 
 
@@ -58,18 +92,17 @@ def update_stocks(stocks, campaign_id, access_token):
         HTTPError: Ответ с кодом 4xx или 5xx.
         ConnectionError: Проблемы подключения к серверу.
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
     payload = {"skus": stocks}
-    url = endpoint_url + f"campaigns/{campaign_id}/offers/stocks"
-    response = requests.put(url, headers=headers, json=payload)
+    body, headers = upload_body(payload)
+    url = STOCKS_URL.format(campaign_id=campaign_id)
+    response = session.put(
+        url,
+        headers={**market_headers(access_token), **headers},
+        data=body,
+        timeout=REQUEST_TIMEOUT,
+    )
     response.raise_for_status()
-    response_object = response.json()
+    response_object = load_json(response.content)
     return response_object
 
 
@@ -88,18 +121,17 @@ def update_price(prices, campaign_id, access_token):
         HTTPError: Ответ с кодом 4xx или 5xx.
         ConnectionError: Проблемы подключения к серверу.
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
     payload = {"offers": prices}
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-prices/updates"
-    response = requests.post(url, headers=headers, json=payload)
+    body, headers = upload_body(payload)
+    url = PRICES_URL.format(campaign_id=campaign_id)
+    response = session.post(
+        url,
+        headers={**market_headers(access_token), **headers},
+        data=body,
+        timeout=REQUEST_TIMEOUT,
+    )
     response.raise_for_status()
-    response_object = response.json()
+    response_object = load_json(response.content)
     return response_object
 
 
@@ -124,16 +156,17 @@ def get_offer_ids(campaign_id, market_token):
         ['101', '102']
     """
     page = ""
-    product_list = []
+    offer_ids = []
     while True:
         some_prod = get_product_list(page, campaign_id, market_token)
-        product_list.extend(some_prod.get("offerMappingEntries"))
+        # С каждой страницы оставляем только shopSku, остальное не храним
+        offer_ids.extend(
+            product.get("offer").get("shopSku")
+            for product in some_prod.get("offerMappingEntries")
+        )
         page = some_prod.get("paging").get("nextPageToken")
         if not page:
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer").get("shopSku"))
     return offer_ids
 
 
@@ -141,8 +174,9 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
     """Создать список остатков.
 
     Args:
-        watch_remnants (list[dict]): Список словарей с данными о часах.
+        watch_remnants (pd.DataFrame): Таблица с данными о часах.
         offer_ids (list): Список ids продуктов, для которых нужно создать остатки.
+                          Список не изменяется.
         warehouse_id (str): id склада.
         
     Return:
@@ -150,7 +184,7 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
 
     Examples:
         Корректное исполнение:
-            >>> watch_remnants = 
+            >>> watch_remnants = pd.DataFrame(
             [
                 {
                     'Код': '101', 
@@ -159,6 +193,7 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
                     'Количество': '5'
                 }
             ]
+            )
             >>> offer_ids = ['101']
             >>> warehouse_fbs_id = env.str("WAREHOUSE_FBS_ID") 
             >>> create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
@@ -171,7 +206,7 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
             ]   
 
         Некорректное исполнение:
-            >>> watch_remnants = 
+            >>> watch_remnants = pd.DataFrame(
             [
                 {
                     'Код': '101', 
@@ -180,52 +215,40 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
                     'Количество': 'null'
                 }
             ]
+            )
             >>> offer_ids = ['101']
             >>> warehouse_fbs_id = env.str("WAREHOUSE_FBS_ID")
             >>> create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
             ValueError: invalid literal for int() with base 10: 'null' 
     """
-    # Уберем то, что не загружено в market
-    stocks = list()
-    date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append(
+    date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def make_stock(sku, count):
+        return {
+            "sku": sku,
+            "warehouseId": warehouse_id,
+            "items": [
                 {
-                    "sku": str(watch.get("Код")),
-                    "warehouseId": warehouse_id,
-                    "items": [
-                        {
-                            "count": stock,
-                            "type": "FIT",
-                            "updatedAt": date,
-                        }
-                    ],
+                    "count": count,
+                    "type": "FIT",
+                    "updatedAt": date,
                 }
-            )
-            offer_ids.remove(str(watch.get("Код")))
+            ],
+        }
+
+    # Уберем то, что не загружено в market
+    codes = watch_remnants["Код"].astype(str)
+    matched = codes.isin(set(offer_ids)) & ~codes.duplicated()
+    if not matched.any():
+        return [make_stock(offer_id, 0) for offer_id in offer_ids]
+    codes = codes[matched].tolist()
+    counts = stock_conversion(watch_remnants.loc[matched, "Количество"])
+    stocks = [make_stock(code, stock) for code, stock in zip(codes, counts)]
     # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
-        stocks.append(
-            {
-                "sku": offer_id,
-                "warehouseId": warehouse_id,
-                "items": [
-                    {
-                        "count": 0,
-                        "type": "FIT",
-                        "updatedAt": date,
-                    }
-                ],
-            }
-        )
+    seen = set(codes)
+    stocks += [
+        make_stock(offer_id, 0) for offer_id in offer_ids if offer_id not in seen
+    ]
     return stocks
 
 
@@ -233,15 +256,16 @@ def create_prices(watch_remnants, offer_ids):
     """Создает список цен для товаров по ids из Яндекс Маркета.
 
     Args:
-        watch_remnants (dict): Данные о товаре из магазина Casio.
+        watch_remnants (pd.DataFrame): Данные о товарах из магазина Casio.
         offer_ids (list): Список ids продуктов из Яндекс Маркета.
+                          Список не изменяется.
 
     Returns:
         list[dict]: Список словарей с дынными о ценах.
 
     Example:
         Корректное использование:
-            >>> watch_remnants = [{'Код': '101', 'Цена': '5990'}]
+            >>> watch_remnants = pd.DataFrame([{'Код': '101', 'Цена': '5990'}])
             >>> offer_ids = ['101']
             >>> create_prices(watch_remnants, offer_ids)
             [
@@ -254,78 +278,88 @@ def create_prices(watch_remnants, offer_ids):
                 }
             ]
         Некорректное исполнение:
-            >>> watch_remnants = [{'Код': '101', "Цена": "null"}]
+            >>> watch_remnants = pd.DataFrame([{'Код': '101', "Цена": "null"}])
             >>> offer_ids = ['101']
             >>> create_prices(watch_remnants, offer_ids)
             ValueError: invalid literal for int() with base 10: 'null' 
     """
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "id": str(watch.get("Код")),
-                # "feed": {"id": 0},
-                "price": {
-                    "value": int(price_conversion(watch.get("Цена"))),
-                    # "discountBase": 0,
-                    "currencyId": "RUR",
-                    # "vat": 0,
-                },
-                # "marketSku": 0,
-                # "shopSku": "string",
-            }
-            prices.append(price)
+    codes = watch_remnants["Код"].astype(str)
+    matched = codes.isin(set(offer_ids))
+    if not matched.any():
+        return []
+    prices = [
+        {
+            "id": code,
+            # "feed": {"id": 0},
+            "price": {
+                "value": int(price),
+                # "discountBase": 0,
+                "currencyId": "RUR",
+                # "vat": 0,
+            },
+            # "marketSku": 0,
+            # "shopSku": "string",
+        }
+        for code, price in zip(
+            codes[matched].tolist(),
+            prices_conversion(watch_remnants.loc[matched, "Цена"]),
+        )
+    ]
     return prices
 
 
-async def upload_prices(watch_remnants, campaign_id, market_token):
+async def upload_prices(watch_remnants, campaign_id, market_token, offer_ids):
     """Асинхронно загружает цены товаров на маркетплейс.
 
-    Функция получает ids продуктов из Яндекс Маркета,
-    создаёт список цен для товаров из `watch_remnants`, и загружает их на маркетплейс
+    Функция создаёт список цен для товаров из `watch_remnants`,
+    которые есть в `offer_ids`, и загружает их на маркетплейс
     частями по 500 товаров за раз.
 
     Args:
-        watch_remnants (list): Остатки товаров.
+        watch_remnants (pd.DataFrame): Остатки товаров.
         campaign_id (str): id компании необходимого для аутентификации запроса.
         market_token (str): Токен продавца для аутентификации запроса.
+        offer_ids (list): ids товаров кампании из `get_offer_ids`,
+                          список не изменяется.
 
     Returns:
         list: Список всех созданных цен.
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
-        update_price(some_prices, campaign_id, market_token)
+    if not prices:
+        return prices
+    await upload_batches(update_price, divide(prices, 500), campaign_id, market_token)
     return prices
 
 
-async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id):
+async def upload_stocks(
+    watch_remnants, campaign_id, market_token, warehouse_id, offer_ids
+):
     """ Загружает остатки товаров на склад и обновляет их Яндекс Маркете.
 
-    Функция получает id товаров для Яндекс Маркета, создаёт остатки товаров,
+    Функция создаёт остатки для переданных id товаров Яндекс Маркета,
     разделяет остатки на партии по 2000 элементов и обновляет их в Яндекс Маркете.
     Затем остатки фильтруются, оставляя только те, 
     у которых количество товаров не равно нулю.
 
     Args:
-        watch_remnants (list): Список остатков товаров для обработки.
+        watch_remnants (pd.DataFrame): Таблица остатков товаров для обработки.
         campaign_id (str): Идентификатор кампании.
         market_token (str): Токен для доступа к API маркетплейса.
         warehouse_id (str): Идентификатор склада.
+        offer_ids (list): ids товаров кампании из `get_offer_ids`,
+                          список не изменяется.
 
     Returns:
         tuple: Кортеж из двух элементов:
             not_empty (list): Список остатков с ненулевым количеством товаров.
             stocks (list): Все остатки товаров, включая нулевые.
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
     stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
-        update_stocks(some_stock, campaign_id, market_token)
-    not_empty = list(
-        filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
+    await upload_batches(
+        update_stocks, divide(stocks, 2000), campaign_id, market_token
     )
+    not_empty = [stock for stock in stocks if stock["items"][0]["count"] != 0]
     return not_empty, stocks
 
 
@@ -342,24 +376,49 @@ def main():
         # FBS
         offer_ids = get_offer_ids(campaign_fbs_id, market_token)
         # Обновить остатки FBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_fbs_id, market_token)
+        asyncio.run(
+            upload_stocks(
+                watch_remnants,
+                campaign_fbs_id,
+                market_token,
+                warehouse_fbs_id,
+                offer_ids,
+            )
+        )
         # Поменять цены FBS
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
+        asyncio.run(
+            upload_prices(watch_remnants, campaign_fbs_id, market_token, offer_ids)
+        )
 
         # DBS
         offer_ids = get_offer_ids(campaign_dbs_id, market_token)
         # Обновить остатки DBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_dbs_id, market_token)
+        asyncio.run(
+            upload_stocks(
+                watch_remnants,
+                campaign_dbs_id,
+                market_token,
+                warehouse_dbs_id,
+                offer_ids,
+            )
+        )
         # Поменять цены DBS
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
-    except requests.exceptions.ReadTimeout:
+        asyncio.run(
+            upload_prices(watch_remnants, campaign_dbs_id, market_token, offer_ids)
+        )
+    except requests.exceptions.Timeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error:
-        print(error, "Ошибка соединения")
+        # Таймаут чтения приходит как ConnectionError: после исчерпания
+        # повторов в MaxRetryError.reason, при чтении тела напрямую
+        cause = error.args[0] if error.args else None
+        reason = getattr(cause, "reason", None)
+        if isinstance(reason or cause, ReadTimeoutError):
+            print("Превышено время ожидания...")
+        else:
+            print(error, "Ошибка соединения")
+    except requests.exceptions.RetryError as error:
+        print(error, "Исчерпаны повторные попытки")
     except Exception as error:
         print(error, "ERROR_2")
 
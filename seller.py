@@ -1,15 +1,127 @@
+import asyncio
+import concurrent.futures
+import functools
+import gzip
 import io
+import itertools
 import logging.config
-import os
 import re
+import tempfile
 import zipfile
 from environs import Env
 
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    import json as orjson_compat
+
+    orjson = None
 
 logger = logging.getLogger(__file__)
 
+OZON_HEADERS = {"Content-Type": "application/json"}
+OZON_URL = "https://api-seller.ozon.ru/"
+PRODUCT_LIST_URL = OZON_URL + "v2/product/list"
+PRICES_URL = OZON_URL + "v1/product/import/prices"
+STOCKS_URL = OZON_URL + "v1/product/import/stocks"
+CASIO_URL = "https://timeworld.ru/upload/files/ostatki.zip"
+UPLOAD_CONCURRENCY = 8
+# Таймауты (подключение, чтение) в секундах для всех запросов
+REQUEST_TIMEOUT = (5, 30)
+NON_DIGITS = re.compile("[^0-9]")
+DOWNLOAD_SPOOL_SIZE = 8 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Сжимать тела запросов на загрузку остатков и цен (Content-Encoding: gzip)
+GZIP_UPLOADS = False
+
+session = requests.Session()
+session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=["GET", "POST", "PUT"],
+        ),
+    ),
+)
+
+
+@functools.lru_cache(maxsize=None)
+def ozon_headers(client_id, seller_token):
+    """Собрать заголовки запроса к api Ozon.
+
+    Результат кешируется по паре id клиента и токена, поэтому словарь
+    не пересоздаётся на каждой странице и партии. Изменять возвращаемый
+    словарь нельзя.
+
+    Args:
+        client_id (str): id клиента необходимый для аутентификации запроса.
+        seller_token (str): Токен продавца для аутентификации запроса.
+
+    Returns:
+        dict: Заголовки запроса.
+    """
+    return {**OZON_HEADERS, "Client-Id": client_id, "Api-Key": seller_token}
+
+
+def dump_json(payload) -> bytes:
+    """Сериализовать тело запроса в JSON.
+
+    Использует orjson, если он установлен, иначе стандартный json.
+
+    Args:
+        payload (dict): Данные для отправки в api.
+
+    Returns:
+        bytes: JSON в кодировке UTF-8.
+    """
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return orjson_compat.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+def upload_body(payload):
+    """Подготовить тело запроса на загрузку остатков или цен.
+
+    При включенном GZIP_UPLOADS тело сжимается gzip с уровнем 1.
+
+    Args:
+        payload (dict): Данные для отправки в api.
+
+    Returns:
+        tuple: Кортеж из двух элементов:
+            body (bytes): Тело запроса.
+            headers (dict): Дополнительные заголовки запроса.
+    """
+    body = dump_json(payload)
+    if not GZIP_UPLOADS:
+        return body, {}
+    return gzip.compress(body, compresslevel=1), {"Content-Encoding": "gzip"}
+
+
+def load_json(content: bytes):
+    """Разобрать JSON из тела ответа api.
+
+    Args:
+        content (bytes): Тело ответа, например `response.content`.
+
+    Returns:
+        dict: Разобранный ответ api.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return orjson_compat.loads(content)
+
 
 def get_product_list(last_id, client_id, seller_token):
     """Получить список товаров с магазина озон.
@@ -26,11 +138,6 @@ def get_product_list(last_id, client_id, seller_token):
         HTTPError: Ответ с кодом 4xx или 5xx.
         ConnectionError: Проблемы подключения к серверу.
     """
-    url = "https://api-seller.ozon.ru/v2/product/list"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
     payload = {
         "filter": {
             "visibility": "ALL",
@@ -38,9 +145,14 @@ def get_product_list(last_id, client_id, seller_token):
         "last_id": last_id,
         "limit": 1000,
     }
-    response = requests.post(url, json=payload, headers=headers)
+    response = session.post(
+        PRODUCT_LIST_URL,
+        data=dump_json(payload),
+        headers=ozon_headers(client_id, seller_token),
+        timeout=REQUEST_TIMEOUT,
+    )
     response.raise_for_status()
-    response_object = response.json()
+    response_object = load_json(response.content)
     return response_object.get("result")
 
 
@@ -73,9 +185,7 @@ def get_offer_ids(client_id, seller_token):
         last_id = some_prod.get("last_id")
         if total == len(product_list):
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer_id"))
+    offer_ids = [product.get("offer_id") for product in product_list]
     return offer_ids
 
 
@@ -94,15 +204,16 @@ def update_price(prices: list, client_id, seller_token):
         HTTPError: Ответ с кодом 4xx или 5xx.
         ConnectionError: Проблемы подключения к серверу.
     """
-    url = "https://api-seller.ozon.ru/v1/product/import/prices"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
     payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
+    body, headers = upload_body(payload)
+    response = session.post(
+        PRICES_URL,
+        data=body,
+        headers={**ozon_headers(client_id, seller_token), **headers},
+        timeout=REQUEST_TIMEOUT,
+    )
     response.raise_for_status()
-    return response.json()
+    return load_json(response.content)
 
 
 def update_stocks(stocks: list, client_id, seller_token):
@@ -120,27 +231,29 @@ def update_stocks(stocks: list, client_id, seller_token):
         HTTPError: Ответ с кодом 4xx или 5xx.
         ConnectionError: Проблемы подключения к серверу.
     """
-    url = "https://api-seller.ozon.ru/v1/product/import/stocks"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
     payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
+    body, headers = upload_body(payload)
+    response = session.post(
+        STOCKS_URL,
+        data=body,
+        headers={**ozon_headers(client_id, seller_token), **headers},
+        timeout=REQUEST_TIMEOUT,
+    )
     response.raise_for_status()
-    return response.json()
+    return load_json(response.content)
 
 
 def download_stock():
     """Скачать и обработать файл ostatki с сайта casio.
 
     Делает запрос на сайт casio и качает оттуда
-    архив с информацией об остатках, записывается
-    в watch_remnants и архив удаляется.
+    архив с информацией об остатках. Архив скачивается потоком
+    в SpooledTemporaryFile (на диск только если больше
+    DOWNLOAD_SPOOL_SIZE), файл ostatki.xls читается прямо из архива.
 
     Return:
-        list[dict]: Список словарей, где каждый словарь представляет собой 
-                    запись о товаре.
+        pd.DataFrame: Таблица остатков, где каждая строка представляет собой
+                      запись о товаре.
 
     Raises:
         HTTPError: Ответ с кодом 4xx или 5xx.
@@ -148,31 +261,28 @@ def download_stock():
 
     Examples:
         >>> download_stock()
-        [
-            {
-                'Код': '101', 
-                'Наименование товара': 'Часы_1',
-                'Цена': "5'990.00 руб.", 
-                'Количество': '5'
-            }
-        ]
+            Код Наименование товара           Цена Количество
+        0   101             Часы_1  5'990.00 руб.          5
     """
     # Скачать остатки с сайта
-    casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
-    session = requests.Session()
-    response = session.get(casio_url)
-    response.raise_for_status()
-    with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
+    response = session.get(CASIO_URL, stream=True, timeout=REQUEST_TIMEOUT)
+    with response, tempfile.SpooledTemporaryFile(
+        max_size=DOWNLOAD_SPOOL_SIZE
+    ) as buffer:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+        buffer.seek(0)
+        with zipfile.ZipFile(buffer) as archive:
+            excel_file = archive.read("ostatki.xls")
     # Создаем список остатков часов:
-    excel_file = "ostatki.xls"
     watch_remnants = pd.read_excel(
-        io=excel_file,
+        io=io.BytesIO(excel_file),
+        engine="calamine",
         na_values=None,
         keep_default_na=False,
         header=17,
-    ).to_dict(orient="records")
-    os.remove("./ostatki.xls")  # Удалить файл
+    )
     return watch_remnants
 
 
@@ -180,15 +290,16 @@ def create_stocks(watch_remnants, offer_ids):
     """Создать список остатков.
 
     Args:
-        watch_remnants (list[dict]): Список словарей с данными о часах.
+        watch_remnants (pd.DataFrame): Таблица с данными о часах.
         offer_ids (list[str]): Список ids, для которых нужно создать остатки.
+                               Список не изменяется.
 
     Return:
         list[dict]: Список словарей с id и остатками товаров.
 
     Examples:
         Корректное исполнение:
-            >>> watch_remnants = 
+            >>> watch_remnants = pd.DataFrame(
             [
                 {
                     'Код': '101', 
@@ -197,12 +308,13 @@ def create_stocks(watch_remnants, offer_ids):
                     'Количество': '5'
                 }
             ]
+            )
             >>> offer_ids = ['101']
             >>> create_stocks(watch_remnants, offer_ids)
             [{'offer_id': '101', 'stock': 5}]
 
         Некорректное исполнение:
-             >>> watch_remnants = 
+             >>> watch_remnants = pd.DataFrame(
             [
                 {
                     'Код': '101', 
@@ -211,26 +323,28 @@ def create_stocks(watch_remnants, offer_ids):
                     'Количество': 'null'
                 }
             ]
+            )
             >>> offer_ids = ['101']
             >>> create_stocks(watch_remnants, offer_ids)
             ValueError: invalid literal for int() with base 10: 'null'
     """
     # Уберем то, что не загружено в seller
-    stocks = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
+    codes = watch_remnants["Код"].astype(str)
+    matched = codes.isin(set(offer_ids)) & ~codes.duplicated()
+    if not matched.any():
+        return [{"offer_id": offer_id, "stock": 0} for offer_id in offer_ids]
+    codes = codes[matched].tolist()
+    counts = stock_conversion(watch_remnants.loc[matched, "Количество"])
+    stocks = [
+        {"offer_id": code, "stock": stock} for code, stock in zip(codes, counts)
+    ]
     # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
-        stocks.append({"offer_id": offer_id, "stock": 0})
+    seen = set(codes)
+    stocks += [
+        {"offer_id": offer_id, "stock": 0}
+        for offer_id in offer_ids
+        if offer_id not in seen
+    ]
     return stocks
 
 
@@ -238,17 +352,18 @@ def create_prices(watch_remnants, offer_ids):
     """Создает список цен для товаров, которые присутствуют в offer_ids.
 
     Args:
-        watch_remnants (list[dict]): Список словарей с остатками товаров 
-                                     из магазине casio.
+        watch_remnants (pd.DataFrame): Таблица с остатками товаров 
+                                       из магазине casio.
         offer_ids (list[dict]): Список ids товаров из ozon, 
                                 для которых создаются цены.
+                                Список не изменяется.
 
     Return:
         list[dict]: Список словарей с информацией о ценах.
 
     Examples:
         Корректное исполнение:
-            >>> watch_remnants = [{'Код': '101', 'Цена': '5990'}]
+            >>> watch_remnants = pd.DataFrame([{'Код': '101', 'Цена': '5990'}])
             >>> offer_ids = ['101']
             >>> create_prices(watch_remnants, offer_ids)
             [
@@ -262,24 +377,30 @@ def create_prices(watch_remnants, offer_ids):
             ]
 
         Некорректное исполнение:
-            >>> watch_remnants = [{'Код': '101', 'Цена': '5990'}]
+            >>> watch_remnants = pd.DataFrame([{'Код': '101', 'Цена': '5990'}])
             >>> offer_ids = ['999']
             >>> create_prices(watch_remnants, offer_ids)
             []
             (если ни один из товаров не найден в `offer_ids`, 
             возвращается пустой список)
     """
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "auto_action_enabled": "UNKNOWN",
-                "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
-                "old_price": "0",
-                "price": price_conversion(watch.get("Цена")),
-            }
-            prices.append(price)
+    codes = watch_remnants["Код"].astype(str)
+    matched = codes.isin(set(offer_ids))
+    if not matched.any():
+        return []
+    prices = [
+        {
+            "auto_action_enabled": "UNKNOWN",
+            "currency_code": "RUB",
+            "offer_id": code,
+            "old_price": "0",
+            "price": price,
+        }
+        for code, price in zip(
+            codes[matched].tolist(),
+            prices_conversion(watch_remnants.loc[matched, "Цена"]),
+        )
+    ]
     return prices 
 
 
@@ -306,14 +427,61 @@ def price_conversion(price: str) -> str:
             (если не переданы цифры, то код удалит всё и оставит пустую строку)
 
     """
-    return re.sub("[^0-9]", "", price.split(".")[0])
+    return NON_DIGITS.sub("", price.split(".", 1)[0])
 
 
-def divide(lst: list, n: int):
+def prices_conversion(prices: pd.Series) -> list:
+    """Преобразовать колонку цен в строки, состоящие только из цифр.
+
+    Векторная версия `price_conversion` для всей колонки "Цена".
+
+    Args:
+        prices (pd.Series): Колонка цен из таблицы остатков.
+
+    Return:
+        list[str]: Цены без валюты и доп символов.
+
+    Examples:
+        >>> prices_conversion(pd.Series(["5'990.00 руб.", "price"]))
+        ['5990', '']
+    """
+    return (
+        prices.astype(str)
+        .str.split(".", n=1)
+        .str[0]
+        .str.replace(NON_DIGITS, "", regex=True)
+        .tolist()
+    )
+
+
+def stock_conversion(counts: pd.Series) -> list:
+    """Преобразовать колонку "Количество" в числа остатков.
+
+    Значение ">10" превращается в 100, "1" в 0, остальные приводятся к int.
+
+    Args:
+        counts (pd.Series): Колонка количества из таблицы остатков.
+
+    Return:
+        list[int]: Остатки товаров.
+
+    Raises:
+        ValueError: Количество не является числом.
+
+    Examples:
+        >>> stock_conversion(pd.Series([">10", "1", "5"]))
+        [100, 0, 5]
+    """
+    return counts.astype(str).replace({">10": "100", "1": "0"}).astype(int).tolist()
+
+
+def divide(lst, n: int):
     """Разделить список на части по n элементов.
 
+    Части собираются лениво, поэтому `lst` может быть и генератором.
+
     Args:
-        lst (list): Список, который нужно разделить.
+        lst (iterable): Список, который нужно разделить.
         n (int): По сколько элементов будет одна часть.
 
     Returns:
@@ -327,55 +495,99 @@ def divide(lst: list, n: int):
         >>> divide(lst, n)
         '102'
     """
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+    items = iter(lst)
+    while chunk := list(itertools.islice(items, n)):
+        yield chunk
+
+
+async def upload_batches(update, batches, *args):
+    """Параллельно отправить партии данных в api.
+
+    Запускается UPLOAD_CONCURRENCY обработчиков, которые по очереди берут
+    партии из общего итератора и отправляют каждую отдельным вызовом
+    `update` в собственном пуле из UPLOAD_CONCURRENCY потоков. Партии берутся лениво, поэтому генератор
+    `divide` не собирается в память целиком. Если одна из партий упала,
+    остальные обработчики останавливаются.
+
+    Args:
+        update (callable): Функция обновления, например `update_stocks`.
+        batches (iterable[list]): Партии данных, например из `divide`.
+        *args: Остальные аргументы `update` (id клиента, токен и т.п.).
+
+    Returns:
+        list[dict]: Ответы api в порядке партий.
+
+    Raises:
+        HTTPError: Ответ с кодом 4xx или 5xx.
+        ConnectionError: Проблемы подключения к серверу.
+    """
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY)
+    batch_iter = enumerate(batches)
+    responses = {}
+
+    async def worker():
+        for index, batch in batch_iter:
+            responses[index] = await loop.run_in_executor(
+                executor, functools.partial(update, batch, *args)
+            )
+
+    workers = [asyncio.create_task(worker()) for _ in range(UPLOAD_CONCURRENCY)]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for task in workers:
+            task.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+    return [responses[index] for index in sorted(responses)]
 
 
-async def upload_prices(watch_remnants, client_id, seller_token):
+async def upload_prices(watch_remnants, client_id, seller_token, offer_ids):
     """Загружает и обновляет цены товаров в Ozon.
 
-    Функция получает ids товаров. Cоздает цены на основе переданных 
-    данных об остатках товаров. Разделяет цены на партии по 1000 элементов и 
+    Функция создает цены для переданных ids товаров на основе данных
+    об остатках товаров. Разделяет цены на партии по 1000 элементов и
     обновляет их.
 
     Args:
-        watch_remnants (list): Список остатков товаров.
+        watch_remnants (pd.DataFrame): Таблица остатков товаров.
         client_id (str): id клиента необходимый для аутентификации запроса.
         seller_token (str): Токен продавца для аутентификации запроса.
+        offer_ids (list): ids товаров из `get_offer_ids`, список не изменяется.
 
     Returns:
         list: Список всех созданных цен.
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
+    if not prices:
+        return prices
+    await upload_batches(update_price, divide(prices, 1000), client_id, seller_token)
     return prices
 
 
-async def upload_stocks(watch_remnants, client_id, seller_token):
+async def upload_stocks(watch_remnants, client_id, seller_token, offer_ids):
     """Загружает и обновляет остатки товаров для Ozon.
 
-    Функция получает ids товаров, cоздает остаткb товаров, разделяет остатки 
+    Функция cоздает остатки для переданных ids товаров, разделяет остатки 
     на партии по 100 элементов и обновляет их. Фильтрует остатки, оставляя 
     только те, у которых количество товаров не равно нулю.
 
     Args:
-        watch_remnants (list): Список остатков товаров.
+        watch_remnants (pd.DataFrame): Таблица остатков товаров.
         client_id (str): id клиента необходимый для аутентификации запроса.
         seller_token (str): Токен продавца для аутентификации запроса.
-
+        offer_ids (list): ids товаров из `get_offer_ids`, список не изменяется.
 
     Returns:
         tuple: Кортеж из двух элементов:
             not_empty (list): Список остатков с ненулевым количеством товаров.
             stocks (list): Все остатки товаров, включая нулевые.
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
     stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
-    not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
+    await upload_batches(update_stocks, divide(stocks, 100), client_id, seller_token)
+    not_empty = [stock for stock in stocks if stock["stock"] != 0]
     return not_empty, stocks
 
 
@@ -388,16 +600,27 @@ def main():
         watch_remnants = download_stock()
         # Обновить остатки
         stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
+        asyncio.run(
+            upload_batches(update_stocks, divide(stocks, 100), client_id, seller_token)
+        )
         # Поменять цены
         prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
-    except requests.exceptions.ReadTimeout:
+        asyncio.run(
+            upload_batches(update_price, divide(prices, 900), client_id, seller_token)
+        )
+    except requests.exceptions.Timeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error:
-        print(error, "Ошибка соединения")
+        # Таймаут чтения приходит как ConnectionError: после исчерпания
+        # повторов в MaxRetryError.reason, при чтении тела напрямую
+        cause = error.args[0] if error.args else None
+        reason = getattr(cause, "reason", None)
+        if isinstance(reason or cause, ReadTimeoutError):
+            print("Превышено время ожидания...")
+        else:
+            print(error, "Ошибка соединения")
+    except requests.exceptions.RetryError as error:
+        print(error, "Исчерпаны повторные попытки")
     except Exception as error:
         print(error, "ERROR_2")
 